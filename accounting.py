@@ -1,11 +1,15 @@
+import random
+import time
 from dataclasses import dataclass
 from decimal import Decimal
-from typing import Optional, NewType, Any, Iterator
+from functools import wraps
+from typing import Optional, NewType, Any, Iterator, Self, Callable, TypeVar
 from uuid import UUID, uuid4
 
 import sqlalchemy
-from sqlalchemy import select
-from sqlalchemy.orm import Session
+from sqlalchemy import select, insert, update, func, literal, bindparam
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.orm import Session, aliased, load_only
 
 from db import Account, Tx, TxType
 
@@ -15,6 +19,19 @@ TransactionId = NewType("TransactionId", bytes)
 Money = NewType("Money", Decimal)
 
 
+def to_money(amount: Decimal | float | int | str) -> Money:
+    """
+    Convert an amount entered by the user to Money.
+
+    Floats are converted through their shortest repr, Decimal(0.1) would be
+    the exact binary value 0.1000000000000000055511151231257827..., which
+    is not a whole number of cents.
+    """
+    if isinstance(amount, float):
+        amount = str(amount)
+    return Money(Decimal(amount))
+
+
 @dataclass
 class Balance:
     # Amount of money owned by the account
@@ -29,25 +46,229 @@ class AutocommitSessionTransaction:
     A mixin class that handles dealing opening and automatically committing
     database transaction when using an instance of the class as a context
     manager.
+
+    If the session is already in a transaction when the context manager is
+    entered, for example when it's shared with the rest of the application
+    through from_session(), the block runs in a SAVEPOINT instead, so that it
+    only commits or rolls back along with the outer transaction.
     """
 
-    def __init__(self, engine: sqlalchemy.Engine):
+    def __init__(self, engine: sqlalchemy.Engine, session: Optional[Session] = None):
         self.engine = engine
-        self.session = Session(self.engine)
+        # don't expire objects at commit, Tx rows are immutable and the
+        # session is closed right after, so objects loaded in the block stay
+        # usable afterwards instead of failing to refresh while detached
+        #
+        # the ledger writes Tx with Core statements and the only objects it
+        # adds to the session are from create_account(), so there's nothing
+        # for autoflush to do before each query, the commit flushes them
+        if session is None:
+            session = Session(self.engine, autoflush=False, expire_on_commit=False)
+            self._owns_session = True
+        else:
+            # a session that was passed in belongs to the caller, and is not
+            # closed after each operation
+            self._owns_session = False
+        self.session = session
+        self._session_transactions: list[sqlalchemy.orm.SessionTransaction] = []
+
+    @classmethod
+    def from_session(cls, session: Session) -> Self:
+        """Create an instance that uses an existing, caller managed session."""
+        bind = session.get_bind()
+        if isinstance(bind, sqlalchemy.Connection):
+            engine = bind.engine
+        elif isinstance(bind, sqlalchemy.Engine):
+            engine = bind
+        else:
+            raise TypeError(
+                f"session must be bound to an Engine or a Connection, not {bind!r}"
+            )
+        return cls(engine, session)
 
     def __enter__(self) -> sqlalchemy.orm.SessionTransaction:
-        return self.session.begin()
+        if self.session.in_transaction() and (
+            not self._owns_session or self._session_transactions
+        ):
+            session_transaction = self.session.begin_nested()
+        else:
+            if self.session.in_transaction():
+                # a transaction that was autobegun by a read outside of a
+                # block, e.g. get_balance(), it has nothing to commit but a
+                # SAVEPOINT in it would never be committed
+                self.session.commit()
+            session_transaction = self.session.begin()
+        self._session_transactions.append(session_transaction)
+        return session_transaction.__enter__()
 
     def __exit__(self, exc_type: Exception, exc_val: Any, exc_tb: Any) -> None:
-        if exc_type is None:
+        # the SessionTransaction commits, or rolls back if the block raised
+        session_transaction = self._session_transactions.pop()
+        try:
+            session_transaction.__exit__(exc_type, exc_val, exc_tb)
+        finally:
+            if self._owns_session and not session_transaction.nested:
+                self.session.close()
+
+
+# constraints whose violations mean that another Tx has been appended to the
+# same account concurrently
+_CONCURRENT_APPEND_CONSTRAINTS = {"tx_prev_tx_id_key"}
+
+CONCURRENT_APPEND_ATTEMPTS = 5
+CONCURRENT_APPEND_BACKOFF = 0.01
+
+T = TypeVar("T", bound=Callable[..., Any])
+
+
+def _is_concurrent_append(exc: Exception) -> bool:
+    if isinstance(exc, Ledger.ConcurrentUpdate):
+        return True
+    diag = getattr(getattr(exc, "orig", None), "diag", None)
+    return (
+        isinstance(exc, sqlalchemy.exc.IntegrityError)
+        and diag is not None
+        and diag.constraint_name in _CONCURRENT_APPEND_CONSTRAINTS
+    )
+
+
+def retry_concurrent_append(wrapped: T) -> T:
+    """
+    Retry a Ledger write that lost a race against a concurrent append to the
+    same account or transaction group.
+
+    Appends are optimistic, a conflicting append is detected by the
+    conditional head UPDATEs and by the unique index on prev_tx_id, and the
+    whole database transaction is then rolled back and retried with
+    randomized exponential backoff. Calls with an explicit `prev_tx_id` are
+    never retried, the conflict is what the caller asked to be told about.
+    """
+    @wraps(wrapped)
+    def _func(*args: Any, **kwargs: Any) -> Any:
+        for attempt in range(CONCURRENT_APPEND_ATTEMPTS):
             try:
-                self.session.commit()
-            except Exception:
-                self.session.rollback()
-                raise
-        else:
-            self.session.rollback()
-        self.session.__exit__(exc_type, exc_val, exc_tb)
+                return wrapped(*args, **kwargs)
+            except Exception as e:
+                last_attempt = attempt == CONCURRENT_APPEND_ATTEMPTS - 1
+                if last_attempt or kwargs.get("prev_tx_id") is not None or not _is_concurrent_append(e):
+                    raise
+            time.sleep(random.uniform(0, CONCURRENT_APPEND_BACKOFF * 2 ** attempt))
+        raise AssertionError("unreachable")
+    return _func  # type: ignore[return-value]
+
+
+## Queries
+
+# Statements that are run on every call have a fixed shape, only their bind
+# parameters change. They are built once here, which saves constructing them
+# and generating their compiled cache key on every call.
+
+_SELECT_ACCOUNT_BALANCE = (
+    select(Tx.current_balance, Tx.available_balance)
+    .join(Account, Account.head_tx_id == Tx.id)
+    .where(Account.id == bindparam("account_id"))
+)
+
+
+def _select_account_transactions() -> sqlalchemy.Select[tuple[Tx]]:
+    # walk the prev_tx_id chain in the database, starting from the
+    # NEW_ACCOUNT Tx, each step is a lookup in the unique index on prev_tx_id
+    chain = (
+        select(Tx.id, literal(0).label("position"))
+        .where(Tx.account_id == bindparam("account_id"), Tx.type == TxType.NEW_ACCOUNT)
+        .cte("chain", recursive=True)
+    )
+    next_tx = aliased(Tx)
+    chain = chain.union_all(
+        select(next_tx.id, chain.c.position + 1)
+        .join(chain, next_tx.prev_tx_id == chain.c.id)
+    )
+    return (
+        select(Tx)
+        .join(chain, chain.c.id == Tx.id)
+        .order_by(chain.c.position)
+    )
+
+
+_SELECT_ACCOUNT_TRANSACTIONS = _select_account_transactions()
+
+ITER_TRANSACTIONS_BATCH_SIZE = 1000
+
+# bulk inserts of more than this many Tx are sent with COPY instead of a
+# multi-row INSERT
+COPY_TXS_THRESHOLD = 100
+
+
+def _select_group_context() -> sqlalchemy.Select[tuple[Tx, Tx, Tx]]:
+    account_head_tx = aliased(Tx)
+    group_head_tx = aliased(Tx)
+    return (
+        select(Tx, account_head_tx, group_head_tx)
+        .join(Account, Account.id == Tx.account_id)
+        .join(account_head_tx, account_head_tx.id == Account.head_tx_id)
+        .outerjoin(group_head_tx, group_head_tx.id == Tx.group_head_tx_id)
+        .where(Tx.id == bindparam("group_tx_id"))
+        .options(
+            load_only(Tx.account_id, Tx.type, Tx.amount),
+            load_only(account_head_tx.current_balance, account_head_tx.available_balance),
+            load_only(group_head_tx.pending_amount),
+        )
+        .execution_options(populate_existing=True)
+    )
+
+
+_SELECT_GROUP_CONTEXT = _select_group_context()
+
+
+def _append_tx_statement(set_group_head: bool) -> sqlalchemy.Select[Any]:
+    # the bind parameters are the Tx columns prefixed with "new_", they must
+    # not be named after a column, SQLAlchemy would take parameters named
+    # after a column of the UPDATEd tables as extra SET values
+    insert_tx = (
+        pg_insert(Tx)
+        .values({attr.key: bindparam(f"new_{attr.key}") for attr in sqlalchemy.inspect(Tx).column_attrs})
+        .on_conflict_do_nothing(index_elements=[Tx.idempotency_key])
+        .returning(Tx.id)
+        .cte("insert_tx")
+    )
+    inserted = select(insert_tx).exists()
+    set_account_head = (
+        update(Account)
+        .where(
+            Account.id == bindparam("new_account_id"),
+            Account.head_tx_id == bindparam("new_prev_tx_id"),
+            inserted,
+        )
+        .values(head_tx_id=bindparam("new_id"))
+        .returning(Account.id)
+        .cte("set_account_head")
+    )
+    ctes = [insert_tx, set_account_head]
+    counts = [
+        select(func.count()).select_from(insert_tx).scalar_subquery(),
+        select(func.count()).select_from(set_account_head).scalar_subquery(),
+    ]
+    if set_group_head:
+        set_group_head_tx = (
+            update(Tx)
+            .where(
+                Tx.id == bindparam("new_group_tx_id"),
+                Tx.group_head_tx_id == bindparam("new_group_prev_tx_id"),
+                inserted,
+            )
+            .values(group_head_tx_id=bindparam("new_id"))
+            .returning(Tx.id)
+            .cte("set_group_head")
+        )
+        ctes.append(set_group_head_tx)
+        counts.append(select(func.count()).select_from(set_group_head_tx).scalar_subquery())
+    return select(*counts).add_cte(*ctes)
+
+
+# see Ledger._append_tx(), a PENDING Tx starts a new group, other Tx are
+# appended to their group
+_APPEND_PENDING_TX = _append_tx_statement(set_group_head=False)
+_APPEND_GROUP_TX = _append_tx_statement(set_group_head=True)
 
 
 ## API
@@ -57,40 +278,47 @@ class Ledger(AutocommitSessionTransaction):
     class InsufficientFund(Exception):
         pass
 
+    class ConcurrentUpdate(Exception):
+        pass
+
+    class IdempotencyKeyReused(Exception):
+        pass
+
     def create_account(
         self,
         name: str,
         *,
         idempotency_key: Optional[UUID] = None,
     ) -> AccountId:
-        idempotency_key = self._ensure_idempotency_key(idempotency_key)
-        with self:
-            obj = Account(name=name)
+        idempotency_key = idempotency_key or uuid4()
+        account_id = AccountId(uuid4())
+
+        # the NEW_ACCOUNT Tx does not depend on anything in the database, so
+        # it's hashed before the database transaction is started
+        new_account_tx = Tx(
+            idempotency_key=idempotency_key,
+            account_id=account_id,
+            type=TxType.NEW_ACCOUNT,
+            amount=0,
+            pending_amount=0,
+            group_tx_id=None,
+            group_prev_tx_id=None,
+            group_prev_pending_amount=0,
+            prev_tx_id=None,
+            prev_current_balance=0,
+            prev_available_balance=0,
+            current_balance=0,
+            available_balance=0,
+        )
+        new_account_tx._set_transaction_hash()
 
+        with self:
+            obj = Account(id=account_id, name=name, head_tx_id=new_account_tx.id)
             self.session.add(obj)
-            self.session.flush()
-
-            new_account_tx = Tx(
-                idempotency_key=idempotency_key,
-                account_id=obj.id,
-                type=TxType.NEW_ACCOUNT,
-                amount=0,
-                pending_amount=0,
-                group_tx_id=None,
-                group_prev_tx_id=None,
-                group_prev_pending_amount=0,
-                prev_tx_id=None,
-                prev_current_balance=0,
-                prev_available_balance=0,
-                current_balance=0,
-                available_balance=0,
-            )
-
-            new_account_tx._set_transaction_hash()
             self.session.add(new_account_tx)
+            return account_id
 
-            return AccountId(obj.id)
-
+    @retry_concurrent_append
     def create_pending_transaction(
         self,
         account_id: AccountId,
@@ -99,28 +327,50 @@ class Ledger(AutocommitSessionTransaction):
         idempotency_key: Optional[UUID] = None,
         prev_tx_id: Optional[TransactionId] = None,
     ) -> TransactionId:
-        idempotency_key = self._ensure_idempotency_key(idempotency_key)
         with self:
-            prev_tx_id = self._ensure_prev_tx_id(account_id, prev_tx_id)
-            obj = Tx(
-                idempotency_key=idempotency_key,
-                account_id=account_id,
-                type=TxType.PENDING,
-                amount=amount,
-                pending_amount=amount,
-            )
-            self._add_to_account(obj, prev_tx_id)
-            if obj.is_credit:
-                obj.available_balance += amount
-            if obj.available_balance < 0:
-                raise Ledger.InsufficientFund("Insufficient fund")
-
-            obj._set_transaction_hash()
-            obj._set_group_tx_root()
-            self.session.add(obj)
-            self.session.flush()
-            return TransactionId(obj.tx_hash)
+            expected = dict(account_id=account_id, type=TxType.PENDING, amount=amount)
+            replayed_tx_id = self._find_replayed_tx(idempotency_key, **expected)
+            if replayed_tx_id is not None:
+                return replayed_tx_id
+            idempotency_key = idempotency_key or uuid4()
+            prev_tx = self._ensure_prev_tx(account_id, prev_tx_id)
+            obj = self._new_pending_tx(account_id, amount, idempotency_key, prev_tx)
+            if not self._append_tx(obj):
+                return self._get_replayed_tx(idempotency_key, **expected)
+            return TransactionId(obj.id)
+
+    @retry_concurrent_append
+    def create_pending_transactions(
+        self,
+        specs: list[tuple[AccountId, Money]],
+    ) -> list[TransactionId]:
+        """
+        Create a pending transaction for each `(account_id, amount)` in
+        `specs`, in the given order.
 
+        This is equivalent to calling create_pending_transaction() for each
+        spec, except that all of them are created in a single database
+        transaction with a single multi-row INSERT. If any of the transactions
+        fails, none of them are created.
+        """
+        with self:
+            head_txs: dict[AccountId, Tx] = {}
+            prev_txs: dict[AccountId, Tx] = {}
+            objs = []
+            for account_id, amount in specs:
+                if account_id not in prev_txs:
+                    head_txs[account_id] = prev_txs[account_id] = self._get_head_balance_tx(account_id)
+                obj = self._new_pending_tx(account_id, amount, uuid4(), prev_txs[account_id])
+                prev_txs[account_id] = obj
+                objs.append(obj)
+
+            if objs:
+                self._insert_txs(objs)
+            for account_id, head_tx in head_txs.items():
+                self._set_account_head(account_id, head_tx.id, prev_txs[account_id].id)
+            return [TransactionId(obj.id) for obj in objs]
+
+    @retry_concurrent_append
     def settle_transaction(
         self,
         group_tx_id: TransactionId,
@@ -132,18 +382,24 @@ class Ledger(AutocommitSessionTransaction):
         Reflect the transaction amount to the current balance, if
         group_tx_id already have a settled Tx, do nothing.
         """
-        idempotency_key = self._ensure_idempotency_key(idempotency_key)
         with self:
-            group_tx = self._get_group_tx(group_tx_id)
-            prev_tx_id = self._ensure_prev_tx_id(AccountId(group_tx.account_id), prev_tx_id)
+            expected = dict(type=TxType.SETTLEMENT, group_tx_id=group_tx_id)
+            replayed_tx_id = self._find_replayed_tx(idempotency_key, **expected)
+            if replayed_tx_id is not None:
+                return replayed_tx_id
+            idempotency_key = idempotency_key or uuid4()
+            group_tx, account_latest_tx, group_latest_tx = self._get_group_context(group_tx_id)
+            if prev_tx_id is None:
+                prev_tx = account_latest_tx
+            else:
+                prev_tx = self._ensure_prev_tx(AccountId(group_tx.account_id), prev_tx_id)
             obj = Tx(
                 idempotency_key=idempotency_key,
                 account_id=group_tx.account_id,
                 type=TxType.SETTLEMENT,
             )
-            self._add_to_account(obj, prev_tx_id)
-            self._add_to_group(obj, group_tx)
-            group_latest_tx = self.get_latest_group_transaction(group_tx)
+            self._add_to_account(obj, prev_tx)
+            self._add_to_group(obj, group_tx, group_latest_tx)
             settled_amount = group_latest_tx.pending_amount
             obj.amount = settled_amount
             obj.pending_amount = settled_amount
@@ -152,10 +408,11 @@ class Ledger(AutocommitSessionTransaction):
                 obj.available_balance += settled_amount
 
             obj._set_transaction_hash()
-            self.session.add(obj)
-            self.session.flush()
-            return TransactionId(obj.tx_hash)
+            if not self._append_tx(obj):
+                return self._get_replayed_tx(idempotency_key, **expected)
+            return TransactionId(obj.id)
 
+    @retry_concurrent_append
     def refund_pending_transaction(
         self,
         group_tx_id: TransactionId,
@@ -165,13 +422,20 @@ class Ledger(AutocommitSessionTransaction):
         prev_tx_id: Optional[TransactionId] = None,
     ) -> TransactionId:
         """If `amount` is provided, do a partial refund."""
-        idempotency_key = self._ensure_idempotency_key(idempotency_key)
         assert amount, "automatic determination of amount is not yet supported"
         if amount <= 0:
             raise ValueError("Refund amount must be positive")
         with self:
-            group_tx = self._get_group_tx(group_tx_id)
-            prev_tx_id = self._ensure_prev_tx_id(AccountId(group_tx.account_id), prev_tx_id)
+            expected = dict(type=TxType.REFUND, group_tx_id=group_tx_id, amount=amount)
+            replayed_tx_id = self._find_replayed_tx(idempotency_key, **expected)
+            if replayed_tx_id is not None:
+                return replayed_tx_id
+            idempotency_key = idempotency_key or uuid4()
+            group_tx, account_latest_tx, group_latest_tx = self._get_group_context(group_tx_id)
+            if prev_tx_id is None:
+                prev_tx = account_latest_tx
+            else:
+                prev_tx = self._ensure_prev_tx(AccountId(group_tx.account_id), prev_tx_id)
             if not group_tx.is_credit:
                 raise ValueError("Can only refund credit transaction.")
 
@@ -181,76 +445,149 @@ class Ledger(AutocommitSessionTransaction):
                 type=TxType.REFUND,
                 amount=amount,
             )
-            self._add_to_account(obj, prev_tx_id)
-            self._add_to_group(obj, group_tx)
+            self._add_to_account(obj, prev_tx)
+            self._add_to_group(obj, group_tx, group_latest_tx)
             obj.pending_amount = obj.group_prev_pending_amount + amount
             obj.available_balance += amount
 
             obj._set_transaction_hash()
-            self.session.add(obj)
-            self.session.flush()
-            return TransactionId(obj.tx_hash)
+            if not self._append_tx(obj):
+                return self._get_replayed_tx(idempotency_key, **expected)
+            return TransactionId(obj.id)
 
 
     def get_balance(
         self,
         account_id: AccountId,
     ) -> Balance:
-        tx = self.get_latest_transaction(account_id)
+        """
+        The balances are kept up to date on every Tx, so this reads them from
+        the Tx at the head of the account, joined through Account.head_tx_id.
+        """
+        balance = self.session.execute(
+            _SELECT_ACCOUNT_BALANCE,
+            {"account_id": account_id},
+        ).one_or_none()
+        if balance is None:
+            raise ValueError(f"Account {account_id!r} does not exist.")
         return Balance(
-            current=Money(tx.current_balance),
-            available=Money(tx.available_balance),
+            current=Money(balance.current_balance),
+            available=Money(balance.available_balance),
         )
 
     def list_transactions(
         self,
         account_id: AccountId,
     ) -> list[Tx]:
-        results = list(
-            self.session.execute(
-                select(Tx).where(Tx.account_id == account_id)
-            ).scalars()
-        )
-        new_account_tx, = (tx for tx in results if tx.type == TxType.NEW_ACCOUNT)
+        return list(self.iter_transactions(account_id))
 
-        def iterate_sorted_chain(start: Tx) -> Iterator[Tx]:
-            it: Optional[Tx] = start
-            while it:
-                yield it
-                it = it.next_tx
+    def iter_transactions(
+        self,
+        account_id: AccountId,
+    ) -> Iterator[Tx]:
+        """
+        Like list_transactions(), but the transactions are streamed from a
+        server side cursor in batches, instead of loading all of them into
+        memory at once. The iterator has to be consumed within the same
+        database transaction.
+        """
+        yield from self.session.execute(
+            _SELECT_ACCOUNT_TRANSACTIONS,
+            {"account_id": account_id},
+            execution_options={"yield_per": ITER_TRANSACTIONS_BATCH_SIZE},
+        ).scalars()
 
-        return list(iterate_sorted_chain(new_account_tx))
+    def _find_replayed_tx(
+        self,
+        idempotency_key: Optional[UUID],
+        **expected: Any,
+    ) -> Optional[TransactionId]:
+        """
+        Find the Tx that was already recorded with `idempotency_key`.
 
-    def _ensure_idempotency_key(self, idempotency_key: Optional[UUID]) -> UUID:
+        A request that is retried with the same idempotency key returns the
+        Tx of the original request instead of recording a new one. If the Tx
+        with that key doesn't have the `expected` column values, the key has
+        been reused for a different request and this raises
+        IdempotencyKeyReused.
+        """
         if idempotency_key is None:
-            return uuid4()
-        else:
-            return idempotency_key
+            return None
+        tx = self.session.execute(
+            select(Tx.id, *(getattr(Tx, key) for key in expected))
+            .where(Tx.idempotency_key == idempotency_key)
+        ).one_or_none()
+        if tx is None:
+            return None
+        for key, value in expected.items():
+            if getattr(tx, key) != value:
+                raise Ledger.IdempotencyKeyReused(
+                    f"Idempotency key {idempotency_key} has been used for a different transaction."
+                )
+        return TransactionId(tx.id)
+
+    def _get_replayed_tx(self, idempotency_key: UUID, **expected: Any) -> TransactionId:
+        """
+        Like _find_replayed_tx(), for when the Tx is known to exist because a
+        concurrent request with the same `idempotency_key` has recorded it.
+        """
+        replayed_tx_id = self._find_replayed_tx(idempotency_key, **expected)
+        assert replayed_tx_id is not None
+        return replayed_tx_id
 
-    def _ensure_prev_tx_id(
+    def _ensure_prev_tx(
         self,
         account_id: AccountId,
         prev_tx_id: Optional[TransactionId],
-    ) -> TransactionId:
+    ) -> Tx:
         if prev_tx_id is None:
-            tx = self.get_latest_transaction(account_id)
-            return TransactionId(tx.tx_hash)
+            return self._get_head_balance_tx(account_id)
         else:
-            return prev_tx_id
+            prev_tx = self._get_balance_tx(prev_tx_id)
+            assert prev_tx is not None
+            return prev_tx
+
+    def _get_balance_tx(self, tx_id: bytes) -> Optional[Tx]:
+        """
+        Get the Tx `tx_id`, only loading its balances.
+
+        Appending to the account only needs the balances of the previous Tx.
+        Its id and balances are all in the tx_id_account_id_current_balance_available_balance_key
+        index, so PostgreSQL can read them with an index-only scan instead
+        of fetching the whole row. Other attributes are lazy loaded on access.
+        """
+        return self.session.get(
+            Tx,
+            tx_id,
+            options=[load_only(Tx.current_balance, Tx.available_balance)],
+        )
 
-    def _get_group_tx(self, group_tx_id: TransactionId) -> Tx:
-        group_tx = self.session.get(Tx, group_tx_id)
-        if group_tx is None:
+    def _get_group_context(self, group_tx_id: TransactionId) -> tuple[Tx, Tx, Tx]:
+        """
+        Get the pending Tx of the group `group_tx_id`, the Tx at the head of
+        its account and the Tx at the head of the group.
+
+        These are everything that is needed to append a Tx to the group, and
+        they are loaded with one query, with only the columns that are needed
+        for that.
+        """
+        row = self.session.execute(
+            _SELECT_GROUP_CONTEXT,
+            {"group_tx_id": group_tx_id},
+        ).one_or_none()
+        if row is None:
             raise ValueError(f"Transaction group {group_tx_id!r} does not exist.")
-        if group_tx.type != TxType.PENDING:
+        group_tx, account_latest_tx, group_latest_tx = row
+        if group_tx.type is not TxType.PENDING:
             raise ValueError(f"Transaction {group_tx_id!r} is not a Group ID.")
-        return group_tx
+        return group_tx, account_latest_tx, group_latest_tx
 
-    def _add_to_account(self, obj: Tx, prev_tx_id: TransactionId) -> None:
+    def _add_to_account(self, obj: Tx, prev_tx: Tx) -> None:
         """
-        Append the transaction `obj` to its account's event log.
+        Append the transaction `obj` to its account's event log, after `prev_tx`.
 
-        `prev_tx_id` is an optimistic locking key. If provided, the append will
+        `prev_tx` is looked up from the caller's `prev_tx_id`, which is an
+        optimistic locking key. If provided, the append will
         fail if `prev_tx_id` wasn't the last transaction of that account. This
         can be used by clients to ensure that no other concurrent transactions
         have happened during the call. If `prev_tx_id` is not provided, there
@@ -258,57 +595,177 @@ class Ledger(AutocommitSessionTransaction):
         sequencing issues.
         """
         assert obj.id is None, "transaction should not be saved yet"
-        prev_tx = self.session.get(Tx, prev_tx_id)
-        assert prev_tx is not None
         obj.prev_tx_id = prev_tx.id
         obj.prev_current_balance = prev_tx.current_balance
         obj.prev_available_balance = prev_tx.available_balance
         obj.current_balance = prev_tx.current_balance
         obj.available_balance = prev_tx.available_balance
 
-    def _add_to_group(self, obj: Tx, group_tx: Tx) -> None:
+    def _add_to_group(self, obj: Tx, group_tx: Tx, group_latest_tx: Tx) -> None:
         """
-        Append the transaction `obj` to its transaction group's event log.
+        Append the transaction `obj` to its transaction group's event log,
+        after `group_latest_tx`.
         """
-        if group_tx.type != TxType.PENDING:
+        if group_tx.type is not TxType.PENDING:
             raise ValueError("group_tx must be the pending transaction of the group")
 
-        group_latest_tx = self.get_latest_group_transaction(group_tx)
-        assert group_latest_tx is not None
         obj.group_tx_id = group_tx.id
         obj.group_prev_tx_id = group_latest_tx.id
         obj.group_prev_pending_amount = group_latest_tx.pending_amount
 
+    def _new_pending_tx(
+        self,
+        account_id: AccountId,
+        amount: Money,
+        idempotency_key: UUID,
+        prev_tx: Tx,
+    ) -> Tx:
+        """Build the PENDING Tx that is appended to the account after `prev_tx`."""
+        obj = Tx(
+            idempotency_key=idempotency_key,
+            account_id=account_id,
+            type=TxType.PENDING,
+            amount=amount,
+            pending_amount=amount,
+        )
+        self._add_to_account(obj, prev_tx)
+        if obj.is_credit:
+            obj.available_balance += amount
+        if obj.available_balance < 0:
+            raise Ledger.InsufficientFund("Insufficient fund")
+
+        obj._set_transaction_hash()
+        obj._set_group_tx_root()
+        return obj
+
+    def _insert_txs(self, objs: list[Tx]) -> None:
+        """
+        INSERT the new transactions `objs`.
+
+        The Tx objects are only used to build and hash the rows, they are
+        never added to the session. Inserting them with a Core INSERT on the
+        session's connection skips the unit of work, which has nothing to do
+        for rows that are never modified after they are written.
+
+        More than COPY_TXS_THRESHOLD rows are sent with COPY on the
+        underlying psycopg connection, which is much faster to parse and
+        insert than an INSERT with that many VALUES.
+        """
+        connection = self.session.connection()
+        if len(objs) <= COPY_TXS_THRESHOLD:
+            connection.execute(
+                insert(Tx),
+                [obj._column_values() for obj in objs],
+            )
+            return
+
+        # COPY bypasses SQLAlchemy, so convert the values to what the
+        # database stores with the bind processors of the column types, e.g.
+        # the amounts to minor units
+        columns = list(Tx.__table__.columns)
+        processors = [column.type.bind_processor(connection.dialect) for column in columns]
+        column_names = ", ".join(connection.dialect.identifier_preparer.quote(column.name) for column in columns)
+        statement = f"COPY tx ({column_names}) FROM STDIN"
+        driver_connection = connection.connection.driver_connection
+        assert driver_connection is not None
+        dbapi = connection.dialect.loaded_dbapi
+        try:
+            with driver_connection.cursor() as cursor:
+                with cursor.copy(statement) as copy:
+                    for obj in objs:
+                        values = obj._column_values()
+                        copy.write_row([
+                            values[column.key] if processor is None else processor(values[column.key])
+                            for column, processor in zip(columns, processors)
+                        ])
+        except dbapi.Error as e:
+            # raise the driver's errors as the SQLAlchemy exceptions that
+            # Connection.execute() would have raised, e.g. IntegrityError for
+            # a concurrent append, so that they are handled the same way
+            raise sqlalchemy.exc.DBAPIError.instance(
+                statement,
+                None,
+                e,
+                dbapi.Error,
+                dialect=connection.dialect,
+            ) from e
+
+    def _set_account_head(self, account_id: UUID, prev_tx_id: Optional[bytes], tx_id: bytes) -> None:
+        """
+        Move the head of the account's event log to `tx_id`.
+
+        The update is conditional on the head still being `prev_tx_id`, if
+        another transaction has been appended to the account concurrently,
+        this raises ConcurrentUpdate.
+        """
+        result = self.session.execute(
+            update(Account)
+            .where(Account.id == account_id, Account.head_tx_id == prev_tx_id)
+            .values(head_tx_id=tx_id)
+        )
+        if result.rowcount != 1:
+            raise Ledger.ConcurrentUpdate(f"Account {account_id} has been modified concurrently.")
+
+    def _append_tx(self, obj: Tx) -> bool:
+        """
+        INSERT the new transaction `obj`, and move the head of its account, and
+        of its transaction group unless `obj` starts the group, to `obj`.
+
+        The INSERT and the head UPDATEs are sent as a single statement, with
+        each of them in a data modifying CTE. Like _set_account_head(), this
+        raises ConcurrentUpdate if the account or the group had a Tx appended
+        concurrently.
+
+        If a concurrent request has recorded a Tx with the same
+        idempotency_key, nothing is written and this returns False.
+        """
+        statement = _APPEND_PENDING_TX if obj.type is TxType.PENDING else _APPEND_GROUP_TX
+        inserted_count, *updated_counts = self.session.connection().execute(
+            statement,
+            {f"new_{key}": value for key, value in obj._column_values().items()},
+        ).one()
+        if inserted_count == 0:
+            return False
+        if updated_counts[0] != 1:
+            raise Ledger.ConcurrentUpdate(f"Account {obj.account_id} has been modified concurrently.")
+        if len(updated_counts) > 1 and updated_counts[1] != 1:
+            raise Ledger.ConcurrentUpdate(f"Transaction group {obj.group_tx_id!r} has been modified concurrently.")
+        return True
+
     def get_latest_transaction(
         self,
         account_id: AccountId,
     ) -> Tx:
-        """Find the Tx that is never referenced by other Tx.prev_id, this is always the latest Tx"""
-        # FIXME: Calculating the head of the transactions in this way can be
-        #        slow if there's a lot of transactions in the account.
-        #        We would need to record the head of the log in the accounts
-        #        table to optimize this lookup.
-        tx_ids = set(self.session.execute(select(Tx.id).where(Tx.account_id == account_id)).scalars())
-        prev_tx_ids = set(self.session.execute(select(Tx.prev_tx_id).where(Tx.account_id == account_id)).scalars())
-        latest_tx, = tx_ids - prev_tx_ids
-        tx = self.session.get(Tx, latest_tx)
+        """Find the Tx that is at the head of the account's event log"""
+        tx = self.session.get(Tx, self._get_head_tx_id(account_id))
         assert tx is not None
         return tx
 
+    def _get_head_balance_tx(self, account_id: AccountId) -> Tx:
+        """
+        Like get_latest_transaction(), but only loading the balances of the
+        Tx, for appending to the account.
+        """
+        tx = self._get_balance_tx(self._get_head_tx_id(account_id))
+        assert tx is not None
+        return tx
+
+    def _get_head_tx_id(self, account_id: AccountId) -> bytes:
+        # the head is moved with Core statements that bypass the identity map,
+        # so an Account that is already in the session may be stale
+        account = self.session.get(Account, account_id, populate_existing=True)
+        if account is None:
+            raise ValueError(f"Account {account_id!r} does not exist.")
+        assert account.head_tx_id is not None
+        return account.head_tx_id
+
     def get_latest_group_transaction(
         self,
         group_tx: Tx,
     ) -> Tx:
-        """Find the Tx in the Tx group that is never referenced by other
-        Tx.group_prev_tx_id, this is always the latest Tx for that group"""
-        # FIXME: Calculating the head of the transactions in this way can be
-        #        slow if there's a lot of transactions in the account.
-        #        We would need to record the head of the log in the accounts
-        #        table to optimize this lookup.
-        assert group_tx is not None and group_tx.type == TxType.PENDING
-        tx_ids = set(self.session.execute(select(Tx.id).where(Tx.group_tx_id == group_tx.id)).scalars())
-        prev_tx_ids = set(self.session.execute(select(Tx.group_prev_tx_id).where(Tx.group_tx_id == group_tx.id)).scalars())
-        latest_tx, = tx_ids - prev_tx_ids
-        tx = self.session.get(Tx, latest_tx)
+        """Find the Tx that is at the head of the Tx group's event log"""
+        assert group_tx is not None and group_tx.type is TxType.PENDING
+        assert group_tx.group_head_tx_id is not None
+        tx = self.session.get(Tx, group_tx.group_head_tx_id)
         assert tx is not None
         return tx
@@ -4,12 +4,31 @@ from typing import Callable, Any, TypeVar
 from functools import wraps
 import db
 from decimal import Decimal
-from sqlalchemy import select, func
+from sqlalchemy import select, func, bindparam
+from sqlalchemy.orm import aliased
 import sqlalchemy
-import IPython
 
 ledger = accounting.Ledger(db.connect())
 
+# the account name, its number of transactions and the balances of its head
+# Tx, in a single query
+_head_tx = aliased(db.Tx)
+_SELECT_ACCOUNT_SUMMARY = (
+    select(
+        db.Account.name,
+        select(func.count())
+        .where(db.Tx.account_id == db.Account.id)
+        .scalar_subquery()
+        .label("count_tx"),
+        _head_tx.current_balance,
+        _head_tx.available_balance,
+    )
+    .join(_head_tx, _head_tx.id == db.Account.head_tx_id)
+    .where(db.Account.id == bindparam("account_id"))
+)
+_SELECT_ACCOUNT_ID_BY_NAME = select(db.Account.id).where(db.Account.name == bindparam("name"))
+_SELECT_TX_ACCOUNT_ID = select(db.Tx.account_id).where(db.Tx.id == bindparam("tx_id"))
+
 BLUE = "\033[94m"
 CLEAR = "\033[0m"
 help_text = BLUE + '''
@@ -63,29 +82,34 @@ You can also use idempotency_key argument to let the ledger detect duplicate tra
     Out[10]: '2b251dba19244f51f75ed52c9aa2b1c1bd98b75443c4b73d8e37845c68cc195f'
 
     In [11]: create_debit_transaction(30, idempotency_key=ik)
-    ERROR: (psycopg.errors.UniqueViolation) duplicate key value violates unique constraint "tx_idempotency_key_key"
+    Working on jim accounts. jim has 16 transaction(s).
+    Current balance: $145   Available balance: $85
+    Out[11]: '2b251dba19244f51f75ed52c9aa2b1c1bd98b75443c4b73d8e37845c68cc195f'
+
+    In [12]: create_debit_transaction(20, idempotency_key=ik)
+    ERROR: Idempotency key ... has been used for a different transaction.
 
 And prev_tx_id to make a conditional request to the ledger to detect
 concurrency issues, when provided, this argument has similar semantic to HTTP
 If-Match request header when used with a verb that mutates a stateful resource:
 
-    In [12]: tx2 = create_debit_transaction(30)
+    In [13]: tx2 = create_debit_transaction(30)
     Working on jim accounts. jim has 18 transaction(s).
     Current balance: $145   Available balance: $85
 
-    In [13]: create_credit_transaction(30, prev_tx_id=tx2)
+    In [14]: create_credit_transaction(30, prev_tx_id=tx2)
     Working on jim accounts. jim has 19 transaction(s).
     Current balance: $145   Available balance: $55
-    Out[13]: 'b15d91da8dd555bb0bbfce47cc39ee90019e033c0663c28eff678f27b68eb9ff'
+    Out[14]: 'b15d91da8dd555bb0bbfce47cc39ee90019e033c0663c28eff678f27b68eb9ff'
 
-    In [14]: create_credit_transaction(20, prev_tx_id=tx2)
+    In [15]: create_credit_transaction(20, prev_tx_id=tx2)
     ERROR: (psycopg.errors.UniqueViolation) duplicate key value violates unique constraint "tx_prev_tx_id_key"
 
 
 To print balance and list recorded transactions:
 
-    In [15]: print_account_summmary()
-    In [16]: print_transactions()
+    In [16]: print_account_summmary()
+    In [17]: print_transactions()
 
 ''' + CLEAR
 
@@ -122,12 +146,14 @@ def _must_have_active_account() -> None:
 def _validate_group_tx_id(group_tx_id_hex: str) -> accounting.TransactionId:
     with ledger:
         group_tx_id = accounting.TransactionId(bytes.fromhex(group_tx_id_hex))
-        tx = ledger.session.get(db.Tx, group_tx_id)
-        assert tx is not None
-        if tx.account_id != active_account_id:
+        # only the owner is needed to check the Tx, a Tx that does not exist
+        # is reported by the ledger
+        account_id = ledger.session.scalar(_SELECT_TX_ACCOUNT_ID, {"tx_id": group_tx_id})
+        if account_id is not None and account_id != active_account_id:
+            tx_account = ledger.session.get(db.Account, account_id)
             active_account = ledger.session.get(db.Account, active_account_id)
-            assert active_account is not None
-            raise Exception(f"Tx {group_tx_id_hex} belongs to account {tx.account.name}, but currently active account is {active_account.name}. Activate {active_account.name} and retry again to proceed.")
+            assert tx_account is not None and active_account is not None
+            raise Exception(f"Tx {group_tx_id_hex} belongs to account {tx_account.name}, but currently active account is {active_account.name}. Activate {active_account.name} and retry again to proceed.")
         return group_tx_id
 
 
@@ -138,7 +164,7 @@ def create_account(name: str) -> accounting.AccountId:
 def activate_account(name: str) -> None:
     global active_account_id
     with ledger:
-        account_id = ledger.session.scalar(select(db.Account.id).where(db.Account.name == name))
+        account_id = ledger.session.scalar(_SELECT_ACCOUNT_ID_BY_NAME, {"name": name})
         assert account_id is not None
         active_account_id = accounting.AccountId(account_id)
     print_account_summmary()
@@ -146,7 +172,7 @@ def activate_account(name: str) -> None:
 
 def _create_pending_transaction(amount: Decimal | float | int, **kwargs: Any) -> str:
     _must_have_active_account()
-    amount = accounting.Money(Decimal(amount))
+    amount = accounting.to_money(amount)
     _validate_kwargs(kwargs)
     tx_id = ledger.create_pending_transaction(account_id=active_account_id, amount=amount, **kwargs)
     print_account_summmary()
@@ -180,7 +206,7 @@ def settle_transaction(group_tx_id_hex: str, **kwargs: Any) -> None:
 @catch_exception
 def refund_transaction(group_tx_id_hex: str, amount: Decimal | float | int, **kwargs: Any) -> None:
     _must_have_active_account()
-    amount = accounting.Money(Decimal(amount))
+    amount = accounting.to_money(amount)
     group_tx_id = _validate_group_tx_id(group_tx_id_hex)
     _validate_kwargs(kwargs)
     ledger.refund_pending_transaction(group_tx_id, amount)
@@ -190,12 +216,14 @@ def refund_transaction(group_tx_id_hex: str, amount: Decimal | float | int, **kw
 @catch_exception
 def print_account_summmary() -> None:
     with ledger:
-        account = ledger.session.get(db.Account, active_account_id)
-        assert account is not None
-        count_tx = ledger.session.scalar(select(func.count(db.Tx.id)).where(db.Tx.account_id == active_account_id))
-        balance = ledger.get_balance(active_account_id)
-        print(f"Working on {account.name} accounts. {account.name} has {count_tx} transaction(s).")
-        print(f"Current balance: ${balance.current}   Available balance: ${balance.available}")
+        summary = ledger.session.execute(
+            _SELECT_ACCOUNT_SUMMARY,
+            {"account_id": active_account_id},
+        ).one()
+        print(
+            f"Working on {summary.name} accounts. {summary.name} has {summary.count_tx} transaction(s).\n"
+            f"Current balance: ${summary.current_balance}   Available balance: ${summary.available_balance}"
+        )
 
 
 @catch_exception
@@ -207,7 +235,7 @@ def print_transactions() -> None:
         print(f"{account.name}'s transactions")
         print(f"{'Group Id':>64}:{'Tx Hash':64} | {'Type':12} |    Amount ( Pending ) | Cur. Balance | Av. Balance ")
         print(f"-"*197)
-        for tx in ledger.list_transactions(account_id=active_account_id):
+        for tx in ledger.iter_transactions(account_id=active_account_id):
             group_tx = (tx.group_tx_id or b"").hex()
             tx_hash = tx.tx_hash.hex()
             print(f"{group_tx:64}:{tx_hash} | {tx.type.name:12} | ${tx.amount:8} (${tx.pending_amount:8}) | ${tx.current_balance:11} | ${tx.available_balance:10}")
@@ -226,11 +254,16 @@ def reset_database() -> None:
 
 active_account_id = None
 
-ip = IPython.terminal.embed.InteractiveShellEmbed()  # type: ignore[no-untyped-call]
-print(header)
-try:
-    create_database()
-except sqlalchemy.exc.OperationalError as e:
-    print(e)
-    print("You may need to run `docker compose up -d`")
-ip.mainloop()  # type: ignore[no-untyped-call]
+if __name__ == "__main__":
+    # IPython is only imported to run the shell, importing the ui module
+    # doesn't pay for it
+    import IPython
+
+    ip = IPython.terminal.embed.InteractiveShellEmbed()  # type: ignore[no-untyped-call]
+    print(header)
+    try:
+        create_database()
+    except sqlalchemy.exc.OperationalError as e:
+        print(e)
+        print("You may need to run `docker compose up -d`")
+    ip.mainloop()  # type: ignore[no-untyped-call]